@@ -53,7 +53,9 @@ def load_dreambooth_lora(unet, vae=None, text_encoder=None, model_path=None, ble
         unet_state_dict = unet.state_dict()
         for key in converted_unet_checkpoint:
             if key in unet_state_dict:
-                converted_unet_checkpoint[key] = converted_unet_checkpoint[key] * blending_alpha + unet_state_dict[key] * (1.0 - blending_alpha)
+                # blend in fp32 to avoid underflow when the unet weights are fp16, then cast back
+                blended = converted_unet_checkpoint[key].float() * blending_alpha + unet_state_dict[key].float() * (1.0 - blending_alpha)
+                converted_unet_checkpoint[key] = blended.to(unet_state_dict[key].dtype)
             else:
                 print(key)
         
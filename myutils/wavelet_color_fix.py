@@ -26,7 +26,20 @@ def adain_color_fix(target: Image, source: Image):
 
     return result_image
 
-def wavelet_color_fix(target: Image, source: Image):
+def wavelet_color_fix(target, source):
+    # Tensor path: run the wavelet passes on the target's device in its dtype
+    # and return a tensor, skipping the PIL/NumPy round trips entirely
+    if isinstance(target, Tensor):
+        squeeze = target.dim() == 3
+        target_tensor = target.unsqueeze(0) if squeeze else target
+        source_tensor = source if isinstance(source, Tensor) else ToTensor()(source)
+        if source_tensor.dim() == 3:
+            source_tensor = source_tensor.unsqueeze(0)
+        source_tensor = source_tensor.to(device=target_tensor.device, dtype=target_tensor.dtype)
+
+        result_tensor = wavelet_reconstruction(target_tensor, source_tensor).clamp_(0.0, 1.0)
+        return result_tensor.squeeze(0) if squeeze else result_tensor
+
     # Convert images to tensors
     to_tensor = ToTensor()
     target_tensor = to_tensor(target).unsqueeze(0)
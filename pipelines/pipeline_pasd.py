@@ -294,6 +294,11 @@ class StableDiffusionControlNetPipeline(DiffusionPipeline, TextualInversionLoade
         hooks.
         """
         if not hasattr(self.unet, "_hf_hook"):
+            # With the text encoder offloaded to cpu the modules sit on mixed
+            # devices and self.device (the first registered module) is
+            # unreliable, so anchor on the unet, where denoising runs.
+            if getattr(self, "offload_text_encoder", False):
+                return next(self.unet.parameters()).device
             return self.device
         for module in self.unet.modules():
             if (
@@ -931,6 +936,12 @@ class StableDiffusionControlNetPipeline(DiffusionPipeline, TextualInversionLoade
         """
 
         # 3. Encode input prompt
+        # Optionally stream the text encoder through the GPU only for this single
+        # forward, so its weights do not occupy VRAM during the denoising loop.
+        offload_text_encoder = getattr(self, "offload_text_encoder", False)
+        if offload_text_encoder:
+            self.text_encoder.to(device)
+
         prompt_embeds = self._encode_prompt(
             prompt,
             device,
@@ -941,6 +952,10 @@ class StableDiffusionControlNetPipeline(DiffusionPipeline, TextualInversionLoade
             negative_prompt_embeds=negative_prompt_embeds,
         )
 
+        if offload_text_encoder:
+            self.text_encoder.to("cpu")
+            torch.cuda.empty_cache()
+
         # 4. Prepare image
         image = self.prepare_image(
             image=image,
@@ -953,6 +968,8 @@ class StableDiffusionControlNetPipeline(DiffusionPipeline, TextualInversionLoade
             do_classifier_free_guidance=do_classifier_free_guidance,
             guess_mode=guess_mode,
         )
+        # match the memory format of the models so channels_last convs avoid layout transposes
+        image = image.contiguous(memory_format=torch.channels_last)
 
         # 5. Prepare timesteps
         self.scheduler.set_timesteps(num_inference_steps, device=device)
@@ -1045,12 +1062,8 @@ class StableDiffusionControlNetPipeline(DiffusionPipeline, TextualInversionLoade
                         cur_y = max(grid_cols * tile_size-tile_overlap * grid_cols, 0)+tile_size
                         grid_cols += 1
 
-                    input_list = []
-                    cond_list = []
-                    img_list = []
                     noise_preds = []
                     for row in range(grid_rows):
-                        noise_preds_row = []
                         for col in range(grid_cols):
                             if col < grid_cols-1 or row < grid_rows-1:
                                 # extract tile from input image
@@ -1067,54 +1080,41 @@ class StableDiffusionControlNetPipeline(DiffusionPipeline, TextualInversionLoade
                             input_start_y = ofs_y
                             input_end_y = ofs_y + tile_size
 
-                            # input tile dimensions
+                            # Each tile keeps the full (2B) latent batch so it stays
+                            # aligned with prompt_embeds; tiles are processed one at
+                            # a time and stitched below, one prediction per tile.
                             input_tile = latent_model_input[:, :, input_start_y:input_end_y, input_start_x:input_end_x]
-                            input_list.append(input_tile)
                             cond_tile = controlnet_latent_model_input[:, :, input_start_y:input_end_y, input_start_x:input_end_x]
-                            cond_list.append(cond_tile)
                             img_tile = image[:, :, input_start_y*8:input_end_y*8, input_start_x*8:input_end_x*8]
-                            img_list.append(img_tile)
-
-                            if len(input_list) == batch_size or col == grid_cols-1:
-                                input_list_t = torch.cat(input_list, dim=0)
-                                cond_list_t = torch.cat(cond_list, dim=0)
-                                img_list_t = torch.cat(img_list, dim=0)
-                                #print(input_list_t.shape, cond_list_t.shape, img_list_t.shape, fg_mask_list_t.shape)
-
-                                _, down_block_res_samples, mid_block_res_sample = self.controlnet(
-                                    cond_list_t,
-                                    t,
-                                    encoder_hidden_states=controlnet_prompt_embeds,
-                                    controlnet_cond=img_list_t,
-                                    #conditioning_scale=controlnet_conditioning_scale,
-                                    conditioning_scale=conditioning_scale,
-                                    guess_mode=guess_mode,
-                                    return_dict=False,
-                                )
-
-                                if guess_mode and do_classifier_free_guidance:
-                                    # Infered ControlNet only for the conditional batch.
-                                    # To apply the output of ControlNet to both the unconditional and conditional batches,
-                                    # add 0 to the unconditional batch to keep it unchanged.
-                                    down_block_res_samples = [torch.cat([torch.zeros_like(d), d]) for d in down_block_res_samples]
-                                    mid_block_res_sample = torch.cat([torch.zeros_like(mid_block_res_sample), mid_block_res_sample])
-
-                                # predict the noise residual
-                                model_out = self.unet(
-                                    input_list_t,
-                                    t,
-                                    encoder_hidden_states=prompt_embeds,
-                                    cross_attention_kwargs=cross_attention_kwargs,
-                                    down_block_additional_residuals=down_block_res_samples,
-                                    mid_block_additional_residual=mid_block_res_sample,
-                                    return_dict=False,
-                                )[0]
-
-                                #for sample_i in range(model_out.size(0)):
-                                #    noise_preds_row.append(model_out[sample_i].unsqueeze(0))
-                                input_list = []
-                                cond_list = []
-                                img_list = []
+
+                            _, down_block_res_samples, mid_block_res_sample = self.controlnet(
+                                cond_tile,
+                                t,
+                                encoder_hidden_states=controlnet_prompt_embeds,
+                                controlnet_cond=img_tile,
+                                #conditioning_scale=controlnet_conditioning_scale,
+                                conditioning_scale=conditioning_scale,
+                                guess_mode=guess_mode,
+                                return_dict=False,
+                            )
+
+                            if guess_mode and do_classifier_free_guidance:
+                                # Infered ControlNet only for the conditional batch.
+                                # To apply the output of ControlNet to both the unconditional and conditional batches,
+                                # add 0 to the unconditional batch to keep it unchanged.
+                                down_block_res_samples = [torch.cat([torch.zeros_like(d), d]) for d in down_block_res_samples]
+                                mid_block_res_sample = torch.cat([torch.zeros_like(mid_block_res_sample), mid_block_res_sample])
+
+                            # predict the noise residual
+                            model_out = self.unet(
+                                input_tile,
+                                t,
+                                encoder_hidden_states=prompt_embeds,
+                                cross_attention_kwargs=cross_attention_kwargs,
+                                down_block_additional_residuals=down_block_res_samples,
+                                mid_block_additional_residual=mid_block_res_sample,
+                                return_dict=False,
+                            )[0]
 
                             noise_preds.append(model_out)
 